@@ -4,6 +4,9 @@ import yaml
 import glob
 import warnings
 from pathlib import Path
+from typing import Collection
+
+import pandas as pd
 
 body_parts = ["nose",
 "left_ear",
@@ -162,3 +165,116 @@ def get_config_path(working_dir:str, project_name: str|None,
             found_path = True
     assert config_path is not None
     return config_path
+
+# Suffixes DLC appends to the analysis files of tracked videos
+track_method_suffixes = {
+    None: '',
+    'box': '_bx',
+    'skeleton': '_sk',
+    'ellipse': '_el',
+    'transformer': '_tr',
+}
+
+
+def read_config(config_path:str|Path)->dict:
+    """Load a project config file
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+
+    Returns
+    -------
+      config:
+        The content of the config file.
+    """
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+def find_analysis_file(video:str|Path, track_method:str|None='ellipse',
+                       destfolder:str|Path|None=None)->Path:
+    """Locate the `.h5` file DLC wrote when analyzing a video.
+
+    Parameters
+    ----------
+    video:
+      Path to the analyzed video.
+    track_method:
+      Tracking method used during the analysis (determines the file suffix).
+      Set to `None` to get the untracked (and unfiltered) predictions.
+    destfolder:
+      Folder the analysis results were written to.
+      If unset (i.e. `None`) the folder of the video is used.
+
+    Returns
+    -------
+      h5_file:
+        Path to the analysis file. If several files match, the most recent
+        one is used.
+    """
+    if track_method not in track_method_suffixes:
+        raise ValueError(
+            f"Unknown {track_method=}, use one of {list(track_method_suffixes)}"
+        )
+    video = Path(video)
+    folder = Path(destfolder or video.parent)
+    suffix = track_method_suffixes[track_method]
+    # the untracked predictions are neither tracked nor filtered
+    excluded = ('_filtered',) + tuple(s for s in track_method_suffixes.values() if s)
+    matches = [
+        path for path in folder.glob(f"{video.stem}DLC*{suffix}.h5")
+        if track_method is not None or not path.stem.endswith(excluded)
+    ]
+    if not matches:
+        raise FileNotFoundError(
+            f"No analysis file found for {str(video)} in {str(folder)} "
+            f"({track_method=})"
+        )
+    if len(matches) > 1:
+        warnings.warn(
+            f"Found multiple analysis files for {str(video)}.\n"
+            "The most recent one is used."
+        )
+    return max(matches, key=lambda path: path.stat().st_mtime)
+
+def to_pose_array(df:pd.DataFrame, coords:Collection[str]=('x', 'y', 'likelihood'),
+                  individuals:Collection[str]|None=None,
+                  bodyparts:Collection[str]|None=None):
+    """Convert a multi-animal DLC data frame into a dense array.
+
+    Parameters
+    ----------
+    df:
+      Data frame with the DLC column levels (`scorer`, `individuals`,
+      `bodyparts`, `coords`).
+    coords:
+      The coordinates to extract, in this order.
+    individuals:
+      Optional ordering of the individuals. Missing ones are filled with `nan`.
+      If unset (i.e. `None`) the individuals in `df` are used.
+    bodyparts:
+      Optional ordering of the body parts. Missing ones are filled with `nan`.
+      If unset (i.e. `None`) the body parts in `df` are used.
+
+    Returns
+    -------
+      poses:
+        Array of shape (frames, individuals, bodyparts, coords)
+      individuals:
+        The individuals along the 2nd axis
+      bodyparts:
+        The body parts along the 3rd axis
+    """
+    columns = df.columns.droplevel('scorer')
+    individuals = list(individuals or columns.get_level_values('individuals').unique())
+    bodyparts = list(bodyparts or columns.get_level_values('bodyparts').unique())
+    full_columns = pd.MultiIndex.from_product(
+        [individuals, bodyparts, list(coords)],
+        names=['individuals', 'bodyparts', 'coords']
+    )
+    values = df.set_axis(columns, axis=1).reindex(columns=full_columns)
+    poses = values.to_numpy(dtype=float).reshape(
+        len(df), len(individuals), len(bodyparts), len(coords)
+    )
+    return poses, individuals, bodyparts
@@ -0,0 +1,318 @@
+"""Fast conversion and validation of labeled data"""
+import os
+import shutil
+import hashlib
+import warnings
+from pathlib import Path, PurePosixPath
+from typing import Collection
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .helpers import (
+    body_parts,
+    to_pose_array,
+)
+
+# File in each labeled-data folder holding the hash of the last valid conversion
+hash_file = '.labels.sha256'
+
+# Folder (in each labeled-data folder) the replaced CollectedData files are moved to
+backup_folder = '.collected-data-backup'
+
+# Header rows of a multi-animal CollectedData file
+header_rows = ('scorer', 'individuals', 'bodyparts', 'coords')
+
+# Problem reported for labeled frames without image (see `validate_labels`)
+missing_image = "image not found"
+
+
+def folder_hash(folder:str|Path, scorer:str)->str:
+    """Compute a hash of the labels and images in a labeled-data folder
+
+    Parameters
+    ----------
+    folder:
+      Path to the labeled-data folder of a video.
+    scorer:
+      The scorer the labels are converted to.
+    """
+    folder = Path(folder)
+    digest = hashlib.sha256(scorer.encode())
+    for path in sorted(folder.glob('CollectedData_*.csv')):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    for path in sorted(folder.glob('*.png')):
+        digest.update(f"{path.name}:{path.stat().st_size}".encode())
+    return digest.hexdigest()
+
+def read_collected_data(csv_file:str|Path)->pd.DataFrame:
+    """Read a CollectedData csv file as written by the DLC labeling GUI
+
+    Both, the single-column (`labeled-data/<video>/<image>`) and the
+    three-column image index are supported. The returned data frame always
+    uses the three-column index.
+    """
+    with open(csv_file, 'r') as file:
+        first_row = file.readline().split(',')
+    nbr_index = 1 + next(
+        (i for i, cell in enumerate(first_row[1:]) if cell.strip()),
+        len(first_row) - 1
+    )
+    df = pd.read_csv(csv_file, header=list(range(len(header_rows))),
+                     index_col=list(range(nbr_index)))
+    if nbr_index == 1:
+        df.index = pd.MultiIndex.from_tuples(
+            [PurePosixPath(path.replace('\\', '/')).parts[-3:]
+             for path in df.index]
+        )
+    df.columns = df.columns.set_names(list(header_rows))
+    return df
+
+def validate_labels(df:pd.DataFrame, image_sizes:dict,
+                    known_bodyparts:Collection[str]=body_parts,
+                    tolerance:float=1.0)->dict:
+    """Check the labels of a labeled-data folder numerically.
+
+    The following checks are carried out for all frames at once:
+
+    - All body parts are known (see `body_parts`)
+    - All coordinates are within the image bounds
+    - No two individuals are labeled at the same position
+    - The labeled image exists (see `missing_image`)
+
+    Parameters
+    ----------
+    df:
+      Labels as returned by `read_collected_data`.
+    image_sizes:
+      Mapping of the image names to their size (width, height).
+    known_bodyparts:
+      The valid body part names.
+    tolerance:
+      Distance (in pixels) below which two individuals count as duplicates.
+
+    Returns
+    -------
+      failures:
+        Mapping of the image names to a list of problems. Only frames with
+        problems are included.
+    """
+    failures = {}
+    images = [index[-1] for index in df.index]
+
+    unknown = sorted(set(df.columns.get_level_values('bodyparts'))
+                     - set(known_bodyparts))
+    if unknown:
+        for image in images:
+            failures.setdefault(image, []).append(f"unknown body parts {unknown}")
+
+    duplicated = df.columns.duplicated()
+    if duplicated.any():
+        for image in images:
+            failures.setdefault(image, []).append(
+                f"duplicated columns {list(df.columns[duplicated])}"
+            )
+        df = df.loc[:, ~duplicated]
+
+    poses, individuals, bodyparts = to_pose_array(df, coords=('x', 'y'))
+    labeled = ~np.isnan(poses).any(axis=-1)
+
+    # coordinates out of bounds
+    sizes = np.array([image_sizes.get(image, (np.inf, np.inf)) for image in images],
+                     dtype=float)
+    with np.errstate(invalid='ignore'):
+        out_of_bounds = labeled & (
+            (poses < 0).any(axis=-1)
+            | (poses[..., 0] >= sizes[:, None, None, 0])
+            | (poses[..., 1] >= sizes[:, None, None, 1])
+        )
+    for frame, ind, bp in zip(*np.nonzero(out_of_bounds)):
+        failures.setdefault(images[frame], []).append(
+            f"{individuals[ind]}/{bodyparts[bp]} out of the image bounds"
+        )
+
+    # individuals labeled at the same position
+    distances = np.linalg.norm(poses[:, :, None] - poses[:, None], axis=-1)
+    shared = labeled[:, :, None] & labeled[:, None]
+    nbr_shared = shared.sum(axis=-1)
+    same = (np.where(shared, distances <= tolerance, True).all(axis=-1)
+            & (nbr_shared > 0))
+    for frame, ind_a, ind_b in zip(*np.nonzero(np.triu(same, k=1))):
+        failures.setdefault(images[frame], []).append(
+            f"{individuals[ind_a]} and {individuals[ind_b]} are duplicates"
+        )
+    missing = [image for image in images if image not in image_sizes]
+    for image in missing:
+        failures.setdefault(image, []).append(missing_image)
+    return failures
+
+def render_failures(folder:str|Path, df:pd.DataFrame, failures:dict)->Path:
+    """Plot the labels of the frames that failed the validation
+
+    The images are written to `<folder>_labeled`, like `dlc.check_labels` does.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    folder = Path(folder)
+    output_dir = folder.parent / f"{folder.name}_labeled"
+    output_dir.mkdir(exist_ok=True)
+    df = df.loc[:, ~df.columns.duplicated()]
+    images = [index[-1] for index in df.index]
+    poses, individuals, _ = to_pose_array(df, coords=('x', 'y'))
+    colors = plt.get_cmap('rainbow', max(len(individuals), 1))
+    for frame, image in enumerate(images):
+        if image not in failures or not (folder / image).exists():
+            continue
+        fig, ax = plt.subplots()
+        ax.imshow(plt.imread(folder / image))
+        for ind, individual in enumerate(individuals):
+            ax.scatter(poses[frame, ind, :, 0], poses[frame, ind, :, 1], s=6,
+                       color=colors(ind), label=individual)
+        ax.set_title("\n".join(failures[image]), fontsize=6)
+        ax.axis('off')
+        fig.savefig(output_dir / image, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+    return output_dir
+
+def convert_folder(folder:str|Path, scorer:str, force:bool=False):
+    """Convert, re-score and validate the labels of a single labeled-data folder.
+
+    All CollectedData csv files in `folder` are merged, assigned to `scorer`
+    and written to `CollectedData_<scorer>.csv/.h5`. Frames labeled in
+    several files are taken from the file of `scorer`, otherwise from the most
+    recently modified file. Frames whose image does not exist are reported
+    and left out, the other frames are still converted.
+    The labels are validated before anything is written: If the validation
+    fails, the failing frames are rendered and the folder is left untouched.
+    Otherwise, the replaced CollectedData files are moved (or copied) to
+    `backup_folder`.
+
+    Parameters
+    ----------
+    folder:
+      Path to the labeled-data folder of a video.
+    scorer:
+      The scorer the labels are assigned to.
+    force:
+      Convert the folder even if it did not change since the last run.
+
+    Returns
+    -------
+      folder:
+        The processed folder.
+      failures:
+        Mapping of image names to problems (see `validate_labels`) or `None`
+        if the folder was skipped.
+      missing:
+        Names of the labeled images that do not exist (and were left out).
+    """
+    folder = Path(folder)
+    csv_file = folder / f"CollectedData_{scorer}.csv"
+    # least important first, as later files take precedence when merging
+    csv_files = sorted(folder.glob('CollectedData_*.csv'),
+                       key=lambda path: (path == csv_file, path.stat().st_mtime))
+    if not csv_files:
+        return folder, {}, []
+    digest = folder_hash(folder, scorer)
+    h5_file = folder / f"CollectedData_{scorer}.h5"
+    hash_path = folder / hash_file
+    if (not force and h5_file.exists() and hash_path.exists()
+            and hash_path.read_text().strip() == digest):
+        return folder, None, []
+
+    image_sizes = {}
+    for path in folder.glob('*.png'):
+        with Image.open(path) as image:
+            image_sizes[path.name] = image.size
+
+    # Leave out the frames without image, they cannot be used for training
+    sources = [read_collected_data(path) for path in csv_files]
+    missing = sorted({index[-1] for source in sources for index in source.index
+                      if index[-1] not in image_sizes})
+    sources = [source[[index[-1] in image_sizes for index in source.index]]
+               for source in sources]
+
+    # Validate each file on its own, then the merged labels
+    failures = {}
+    for source in sources:
+        for image, problems in validate_labels(source, image_sizes).items():
+            failures.setdefault(image, []).extend(problems)
+    df = None
+    if not failures:
+        df = pd.concat([source.droplevel('scorer', axis=1) for source in sources])
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+        df = pd.concat({scorer: df}, axis=1, names=['scorer'])
+        failures = validate_labels(df, image_sizes)
+    if failures:
+        for source in ([df] if df is not None else sources):
+            render_failures(folder, source, failures)
+        if hash_path.exists():
+            hash_path.unlink()
+        return folder, failures, missing
+
+    # Keep the replaced files, those of other scorers are removed
+    replaced = [path for path in csv_files + sorted(folder.glob('CollectedData_*.h5'))
+                if path not in (csv_file, h5_file)]
+    if replaced or (missing and csv_file.exists()):
+        (folder / backup_folder).mkdir(exist_ok=True)
+        for path in replaced:
+            path.replace(folder / backup_folder / path.name)
+        if missing and csv_file.exists():
+            shutil.copy2(csv_file, folder / backup_folder / csv_file.name)
+    df.to_csv(csv_file)
+    df.to_hdf(h5_file, key='df_with_missing', mode='w')
+    hash_path.write_text(folder_hash(folder, scorer))
+    return folder, failures, missing
+
+def convert_labeled_data(config_path:str|Path, scorer:str,
+                         workers:int|None=None, force:bool=False)->dict:
+    """Convert, re-score and validate all labeled-data folders in parallel.
+
+    This replaces `dlc.convertcsv2h5` followed by `dlc.check_labels`: Folders
+    that did not change since the last successful run are skipped and only
+    frames that fail the validation are rendered.
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+    scorer:
+      The scorer the labels are assigned to.
+    workers:
+      Number of worker processes. Defaults to the number of CPUs.
+    force:
+      Convert all folders even if they did not change.
+
+    Returns
+    -------
+      failures:
+        Mapping of the folders with invalid labels to their problems. These
+        folders were not converted.
+    """
+    labeled_data = Path(os.path.dirname(config_path)) / 'labeled-data'
+    folders = [path for path in sorted(labeled_data.iterdir())
+               if path.is_dir() and not path.name.endswith('_labeled')]
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for folder, failures, missing in executor.map(convert_folder, folders,
+                                                      [scorer] * len(folders),
+                                                      [force] * len(folders)):
+            if missing:
+                warnings.warn(
+                    f"The images of {len(missing)} labeled frames in "
+                    f"{str(folder)} do not exist, their labels are left out: "
+                    f"{missing}"
+                )
+            if failures:
+                results[folder] = failures
+                warnings.warn(
+                    f"{len(failures)} frames in {str(folder)} failed the label "
+                    f"validation, see {str(folder)}_labeled. The labels of "
+                    "this folder were not converted."
+                )
+    return results
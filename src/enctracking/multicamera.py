@@ -0,0 +1,322 @@
+"""Batched inference on synchronized videos of several cameras"""
+import warnings
+import importlib
+import itertools
+import contextlib
+from pathlib import Path
+from typing import Collection
+
+import cv2
+import numpy as np
+import pandas as pd
+from deeplabcut.pose_estimation_pytorch.apis.utils import (
+    get_inference_runners,
+    get_model_snapshots,
+)
+from deeplabcut.pose_estimation_pytorch.data import DLCLoader
+from deeplabcut.pose_estimation_pytorch.modelzoo import (
+    get_super_animal_snapshot_path,
+    load_super_animal_config,
+)
+from deeplabcut.pose_estimation_pytorch.task import Task
+from deeplabcut.utils import auxfun_multianimal
+
+from .helpers import (
+    read_config,
+)
+from .runtime import (
+    resolve_device,
+    swap_models,
+)
+
+
+class MultiCameraVideo:
+    """Decode the synchronized videos of several cameras together.
+
+    Iterating yields the frames (RGB) of all cameras for each time step, i.e.
+    frame 0 of camera 0, frame 0 of camera 1, ..., frame 1 of camera 0, ...
+    The iteration stops with the shortest video.
+
+    Parameters
+    ----------
+    videos:
+      Paths to the videos, one per camera.
+    """
+    def __init__(self, videos:Collection[str|Path]):
+        self.videos = [Path(video) for video in videos]
+        nframes = []
+        for video in self.videos:
+            cap = cv2.VideoCapture(str(video))
+            if not cap.isOpened():
+                raise IOError(f"Unable to open {str(video)}")
+            nframes.append(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+            cap.release()
+        if len(set(nframes)) > 1:
+            warnings.warn(
+                f"The videos have different lengths ({nframes}), only the "
+                f"first {min(nframes)} frames are analyzed."
+            )
+        self.nframes = min(nframes)
+
+    @property
+    def nbr_cameras(self)->int:
+        return len(self.videos)
+
+    def __len__(self):
+        return self.nframes * self.nbr_cameras
+
+    def __iter__(self):
+        caps = [cv2.VideoCapture(str(video)) for video in self.videos]
+        try:
+            for _ in range(self.nframes):
+                frames = []
+                for cap in caps:
+                    ok, frame = cap.read()
+                    if not ok:
+                        return
+                    frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                yield from frames
+        finally:
+            for cap in caps:
+                cap.release()
+
+
+def project_runners(config_path:str, batch_size:int=1, device:str|None=None,
+                    shuffle:int=1, trainset_index:int=0,
+                    snapshot_index:int|None=None,
+                    detector_snapshot_index:int|None=None,
+                    export_dir:str|None=None):
+    """Get the inference runners of a fine-tuned project model
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+    batch_size:
+      Batch size of the pose model and the detector.
+    device:
+      Device to run the inference on.
+    shuffle:
+      The shuffle of the model.
+    trainset_index:
+      The index of the training fraction.
+    snapshot_index:
+      The index of the pose model snapshot to use.
+      If unset (i.e. `None`) the `snapshotindex` of the config is used.
+    detector_snapshot_index:
+      The index of the detector snapshot to use.
+      If unset (i.e. `None`) the `detector_snapshotindex` of the config is used.
+    export_dir:
+      Optional folder with models exported by export_pretrained.py to run
+      the inference through (see `swap_models`).
+
+    Returns
+    -------
+      pose_runner, detector_runner:
+        The runners (`detector_runner` is `None` for bottom-up models).
+    """
+    config = read_config(config_path)
+    if snapshot_index is None:
+        snapshot_index = config.get('snapshotindex', -1)
+    if detector_snapshot_index is None:
+        detector_snapshot_index = config.get('detector_snapshotindex', -1)
+    loader = DLCLoader(config=config_path, shuffle=shuffle,
+                       trainset_index=trainset_index)
+    pose_snapshot = get_model_snapshots(snapshot_index, loader.model_folder,
+                                        loader.pose_task)[0]
+    detector_path = None
+    if loader.pose_task == Task.TOP_DOWN:
+        detector_path = get_model_snapshots(detector_snapshot_index,
+                                            loader.model_folder,
+                                            Task.DETECT)[0].path
+    individuals, unique_bodyparts, bodyparts = (
+        auxfun_multianimal.extractindividualsandbodyparts(config)
+    )
+    pose_runner, detector_runner = get_inference_runners(
+        model_config=loader.model_cfg,
+        snapshot_path=pose_snapshot.path,
+        max_individuals=len(individuals),
+        num_bodyparts=len(bodyparts),
+        num_unique_bodyparts=len(unique_bodyparts),
+        batch_size=batch_size,
+        detector_batch_size=batch_size,
+        device=device,
+        detector_path=detector_path,
+    )
+    if export_dir is not None:
+        swap_models(pose_runner, detector_runner, export_dir=export_dir,
+                    pose_snapshot=pose_snapshot.path,
+                    detector_snapshot=detector_path)
+    return pose_runner, detector_runner
+
+def superanimal_runners(superanimal_name:str, model_name:str,
+                        detector_name:str, max_individuals:int,
+                        batch_size:int=1, detector_batch_size:int|None=None,
+                        bbox_threshold:float|None=None, device:str|None=None):
+    """Get the inference runners of a pretrained ModelZoo model
+
+    Parameters
+    ----------
+    superanimal_name:
+      Identifier of the pretrained model to use.
+    model_name:
+      What network model to use.
+    detector_name:
+      What model to use to detect animals.
+    max_individuals:
+      How many different individuals are maximally visible.
+    batch_size:
+      Batch size of the pose model.
+    detector_batch_size:
+      Batch size of the detector. Defaults to `batch_size`.
+    bbox_threshold:
+      Optional minimal score of the bounding boxes kept by the detector.
+    device:
+      Device to run the inference on (`'auto'` is resolved).
+
+    Returns
+    -------
+      pose_runner, detector_runner:
+        The runners.
+      scorer:
+        Name of the scorer to write the predictions with.
+      bodyparts:
+        The body parts predicted by the model.
+    """
+    model_config = load_super_animal_config(super_animal=superanimal_name,
+                                            model_name=model_name,
+                                            detector_name=detector_name)
+    bodyparts = model_config['metadata']['bodyparts']
+    if bbox_threshold is not None:
+        model_config['detector']['model']['box_score_thresh'] = bbox_threshold
+    pose_runner, detector_runner = get_inference_runners(
+        model_config=model_config,
+        snapshot_path=get_super_animal_snapshot_path(dataset=superanimal_name,
+                                                     model_name=model_name),
+        max_individuals=max_individuals,
+        num_bodyparts=len(bodyparts),
+        num_unique_bodyparts=0,
+        batch_size=batch_size,
+        detector_batch_size=detector_batch_size or batch_size,
+        device=resolve_device(device),
+        detector_path=get_super_animal_snapshot_path(dataset=superanimal_name,
+                                                     model_name=detector_name),
+    )
+    scorer = f"DLC_{superanimal_name}_{model_name}_{detector_name}"
+    return pose_runner, detector_runner, scorer, bodyparts
+
+def multi_camera_inference(videos:Collection[str|Path], pose_runner,
+                           detector_runner=None, batch_size:int=1)->list:
+    """Run the inference on the synchronized videos of several cameras.
+
+    The videos are decoded once: for each shared batch of frames (from all
+    cameras) the detector (if any) and the pose model are run before the
+    next frames are decoded. The batch size of the runners should therefore
+    be `batch_size` times the number of cameras.
+
+    Parameters
+    ----------
+    videos:
+      Paths to the videos, one per camera.
+    pose_runner:
+      DLC inference runner of the pose model.
+    detector_runner:
+      DLC inference runner of the detector (or `None` for bottom-up models).
+    batch_size:
+      Number of time steps per shared batch, i.e. frames per camera.
+
+    Returns
+    -------
+      predictions:
+        One list of frame predictions per camera, aligned by frame index.
+    """
+    stream = MultiCameraVideo(videos)
+    frames = iter(stream)
+    predictions = []
+    while batch := list(itertools.islice(frames, batch_size * stream.nbr_cameras)):
+        inputs = batch
+        if detector_runner is not None:
+            inputs = list(zip(batch, detector_runner.inference(images=batch)))
+        predictions.extend(pose_runner.inference(images=inputs))
+    return [predictions[camera::stream.nbr_cameras]
+            for camera in range(stream.nbr_cameras)]
+
+@contextlib.contextmanager
+def precomputed_predictions(predictions:list, pose_runner=None,
+                            detector_runner=None):
+    """Context in which `dlc.analyze_videos` uses existing predictions.
+
+    The inference step of `dlc.analyze_videos` is replaced by returning
+    `predictions`, while everything else (scorer name, output files,
+    assembly, tracking and stitching) is left to DLC. Hence, only a single
+    video should be analyzed within the context.
+
+    Parameters
+    ----------
+    predictions:
+      The frame predictions of the video (see `multi_camera_inference`).
+    pose_runner, detector_runner:
+      Optional runners the predictions were made with. If set, DLC uses
+      them instead of loading the models again.
+    """
+    module = importlib.import_module(
+        'deeplabcut.pose_estimation_pytorch.apis.analyze_videos'
+    )
+    video_inference = module.video_inference
+    get_inference_runners = module.get_inference_runners
+
+    def _video_inference(*args, **kwargs):
+        return predictions
+
+    def _get_inference_runners(*args, **kwargs):
+        return pose_runner, detector_runner
+
+    module.video_inference = _video_inference
+    if pose_runner is not None:
+        module.get_inference_runners = _get_inference_runners
+    try:
+        yield
+    finally:
+        module.video_inference = video_inference
+        module.get_inference_runners = get_inference_runners
+
+def write_predictions(predictions:list, video:str|Path, scorer:str,
+                      individuals:Collection[str], bodyparts:Collection[str],
+                      destfolder:str|Path|None=None)->Path:
+    """Write the predictions of a video in the DLC format
+
+    Parameters
+    ----------
+    predictions:
+      The frame predictions of the video (see `multi_camera_inference`).
+    video:
+      Path to the video.
+    scorer:
+      Name of the scorer.
+    individuals:
+      Names of the individuals.
+    bodyparts:
+      Names of the body parts.
+    destfolder:
+      Folder to write the results to.
+      If unset (i.e. `None`) the folder of the video is used.
+
+    Returns
+    -------
+      h5_file:
+        Path to the written file (`<video name><scorer>.h5`).
+    """
+    video = Path(video)
+    keypoints = np.stack([prediction['bodyparts'] for prediction in predictions])
+    nbr_individuals = keypoints.shape[1]
+    individuals = list(individuals)[:nbr_individuals]
+    individuals += [f"individual{i}"
+                    for i in range(len(individuals) + 1, nbr_individuals + 1)]
+    columns = pd.MultiIndex.from_product(
+        [[scorer], individuals, list(bodyparts), ['x', 'y', 'likelihood']],
+        names=['scorer', 'individuals', 'bodyparts', 'coords']
+    )
+    df = pd.DataFrame(keypoints.reshape(len(keypoints), -1), columns=columns)
+    h5_file = Path(destfolder or video.parent) / f"{video.stem}{scorer}.h5"
+    df.to_hdf(h5_file, key='df_with_missing', mode='w')
+    return h5_file
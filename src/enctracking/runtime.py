@@ -0,0 +1,300 @@
+"""Run DLC inference through exported (TorchScript) models on the CPU"""
+import os
+import copy
+import time
+import inspect
+import importlib
+import contextlib
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+# Name of the file describing an export (see `export_module`)
+export_metadata = 'export.yaml'
+
+
+class ExportedModel(torch.nn.Module):
+    """Stand-in for a DLC model whose forward pass runs an exported module.
+
+    Everything but the forward pass (e.g. `get_predictions` of a pose model)
+    is taken from the original model, so the inference runners of DLC can
+    use it as a drop-in replacement.
+    """
+    def __init__(self, exported:torch.nn.Module, original:torch.nn.Module):
+        super().__init__()
+        self.exported = exported
+        self.original = original
+
+    def forward(self, *args, **kwargs):
+        outputs = self.exported(*args, **kwargs)
+        # scripted torchvision detectors return (losses, detections)
+        if (isinstance(outputs, tuple) and len(outputs) == 2
+                and isinstance(outputs[1], list)):
+            outputs = outputs[1]
+        return outputs
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.original, name)
+
+
+def resolve_device(device:str|None)->str:
+    """Turn `None` or `'auto'` into the device to run on ('cuda' or 'cpu')"""
+    if device in (None, 'auto'):
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+def model_inputs(runner, image, context:dict|None=None)->torch.Tensor:
+    """Get the tensor a runner feeds its model for an image
+
+    Parameters
+    ----------
+    runner:
+      DLC inference runner.
+    image:
+      Path to the image (or the image itself).
+    context:
+      Optional context of the image, e.g. the bounding boxes predicted by
+      the detector for a top-down pose model.
+    """
+    if runner.preprocessor is None:
+        raise ValueError("The runner has no preprocessor to prepare the inputs.")
+    inputs, _ = runner.preprocessor(image, dict(context or {}))
+    return torch.as_tensor(inputs)
+
+def quantize_module(module:torch.nn.Module,
+                    calibration_inputs:list)->torch.nn.Module:
+    """Get a static int8 quantized copy of a module (FX graph mode).
+
+    The activation ranges are calibrated on real inputs, hence all layers
+    (including the convolutions) are quantized. As the quantized module only
+    approximates the original one, its predictions should be validated.
+
+    Parameters
+    ----------
+    module:
+      The module to quantize.
+    calibration_inputs:
+      Real input tensors (as received by the module) to calibrate on.
+
+    Returns
+    -------
+      quantized:
+        The quantized module (for CPU inference).
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if not calibration_inputs:
+        raise ValueError("Quantization requires inputs to calibrate on.")
+    module = copy.deepcopy(module).cpu().eval()
+    prepared = prepare_fx(module, get_default_qconfig_mapping('x86'),
+                          example_inputs=(calibration_inputs[0],))
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            prepared(inputs)
+    return convert_fx(prepared)
+
+def export_module(module:torch.nn.Module, path:str|Path,
+                  example_inputs:list|None=None)->torch.jit.ScriptModule:
+    """Export a module to TorchScript, optimized for CPU inference.
+
+    Scripting is tried first. If it fails and `example_inputs` are given, the
+    module is traced on the first input and the trace is checked against the
+    others.
+
+    Parameters
+    ----------
+    module:
+      The module to export.
+    path:
+      Where to write the exported module to.
+    example_inputs:
+      Real input tensors (as received by the module) used for tracing.
+      If unset (i.e. `None`) the module is only scripted.
+
+    Returns
+    -------
+      exported:
+        The exported module.
+    """
+    module = module.cpu().eval()
+    try:
+        exported = torch.jit.script(module)
+    except Exception:
+        if not example_inputs:
+            raise
+        with torch.no_grad():
+            exported = torch.jit.trace(
+                module, example_inputs[0], strict=False,
+                check_inputs=[(x,) for x in example_inputs[1:]] or None,
+            )
+    try:
+        exported = torch.jit.optimize_for_inference(exported)
+    except Exception:
+        # e.g. quantized modules cannot always be frozen
+        exported = exported.eval()
+    torch.jit.save(exported, str(path))
+    return exported
+
+def read_export(export_dir:str|Path)->dict:
+    """Load the description of an export
+
+    Parameters
+    ----------
+    export_dir:
+      Folder the models were exported to.
+
+    Returns
+    -------
+      metadata:
+        Content of the `export_metadata` file with the model paths made
+        absolute.
+    """
+    with open(os.path.join(export_dir, export_metadata), 'r') as file:
+        metadata = yaml.safe_load(file)
+    for key in ('pose_model', 'detector_model'):
+        if metadata.get(key):
+            metadata[key] = os.path.join(export_dir, metadata[key])
+    return metadata
+
+def _same_file(path_a:str|Path, path_b:str|Path)->bool:
+    """Whether two paths point to the same file"""
+    return Path(path_a).resolve() == Path(path_b).resolve()
+
+def swap_models(pose_runner, detector_runner, export_dir:str|Path,
+                require_validated:bool=True,
+                pose_snapshot:str|Path|None=None,
+                detector_snapshot:str|Path|None=None):
+    """Make inference runners use the exported models.
+
+    Parameters
+    ----------
+    pose_runner:
+      DLC inference runner of the pose model.
+    detector_runner:
+      DLC inference runner of the detector (or `None`).
+    export_dir:
+      Folder the models were exported to.
+    require_validated:
+      Refuse exports that did not pass the validation of export_pretrained.py.
+    pose_snapshot:
+      Optional path to the snapshot the pose runner was loaded from. It must
+      be the snapshot that was exported.
+    detector_snapshot:
+      Optional path to the snapshot the detector runner was loaded from. It
+      must be the snapshot that was exported.
+
+    Returns
+    -------
+      pose_runner, detector_runner:
+        The runners, modified in place.
+    """
+    metadata = read_export(export_dir)
+    if require_validated and not metadata.get('validated'):
+        raise ValueError(f"The models in {str(export_dir)} did not pass the "
+                         "validation against the original models.")
+    loaded = (('pose_snapshot', pose_snapshot),
+              ('detector_snapshot', detector_snapshot))
+    for key, snapshot in loaded:
+        if snapshot is not None and metadata.get(key) \
+                and not _same_file(snapshot, metadata[key]):
+            raise ValueError(
+                f"The models in {str(export_dir)} were exported from "
+                f"{metadata[key]}, but {str(snapshot)} was loaded. Select the "
+                "exported snapshot (see the `shuffle`, `trainset_index` and "
+                f"`*snapshot_index` entries in {export_metadata}) or export "
+                "the model again."
+            )
+    runners = ((pose_runner, metadata.get('pose_model')),
+               (detector_runner, metadata.get('detector_model')))
+    for runner, path in runners:
+        if runner is None or not path:
+            continue
+        exported = torch.jit.load(path, map_location='cpu')
+        runner.model = ExportedModel(exported, runner.model).eval()
+    return pose_runner, detector_runner
+
+@contextlib.contextmanager
+def use_exported_models(export_dir:str|Path|None):
+    """Context in which `dlc.analyze_videos` runs through exported models.
+
+    The snapshots `dlc.analyze_videos` loads must be the exported ones,
+    otherwise a `ValueError` is raised (see `swap_models`).
+
+    Parameters
+    ----------
+    export_dir:
+      Folder the models were exported to.
+      If unset (i.e. `None`) nothing is changed.
+    """
+    if export_dir is None:
+        yield
+        return
+    module = importlib.import_module(
+        'deeplabcut.pose_estimation_pytorch.apis.analyze_videos'
+    )
+    get_inference_runners = module.get_inference_runners
+    signature = inspect.signature(get_inference_runners)
+
+    def _get_inference_runners(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        return swap_models(*get_inference_runners(*args, **kwargs),
+                           export_dir=export_dir,
+                           pose_snapshot=arguments.get('snapshot_path'),
+                           detector_snapshot=arguments.get('detector_path'))
+
+    module.get_inference_runners = _get_inference_runners
+    try:
+        yield
+    finally:
+        module.get_inference_runners = get_inference_runners
+
+def predict(pose_runner, detector_runner, images:list)->np.ndarray:
+    """Predict the keypoints in a list of images
+
+    Parameters
+    ----------
+    pose_runner:
+      DLC inference runner of the pose model.
+    detector_runner:
+      DLC inference runner of the detector (or `None` for bottom-up models).
+    images:
+      Paths to the images.
+
+    Returns
+    -------
+      keypoints:
+        Array of shape (images, individuals, bodyparts, 3)
+    """
+    inputs = list(images)
+    if detector_runner is not None:
+        bboxes = detector_runner.inference(images=inputs)
+        inputs = list(zip(inputs, bboxes))
+    predictions = pose_runner.inference(images=inputs)
+    return np.stack([prediction['bodyparts'] for prediction in predictions])
+
+def benchmark(pose_runner, detector_runner, images:list, repeats:int=1)->float:
+    """Measure the inference speed in frames per second
+
+    Parameters
+    ----------
+    pose_runner:
+      DLC inference runner of the pose model.
+    detector_runner:
+      DLC inference runner of the detector (or `None`).
+    images:
+      Paths to the images to run the inference on.
+    repeats:
+      How many times to run the inference on all images.
+    """
+    # warm-up (lazy initialisation, memory allocation)
+    predict(pose_runner, detector_runner, images[:1])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict(pose_runner, detector_runner, images)
+    return repeats * len(images) / (time.perf_counter() - start)
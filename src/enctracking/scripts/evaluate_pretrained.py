@@ -3,14 +3,255 @@
 This is script 3 in the workflow.
 """
 
-import deeplabcut as dlc
+import os
+import re
+import json
+import hashlib
 import argparse
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+import yaml
+import deeplabcut as dlc
+from deeplabcut.pose_estimation_pytorch.apis.evaluate import evaluate
+from deeplabcut.pose_estimation_pytorch.apis.utils import (
+    get_inference_runners,
+    get_model_snapshots,
+)
+from deeplabcut.pose_estimation_pytorch.data import DLCLoader
+from deeplabcut.pose_estimation_pytorch.task import Task
+from deeplabcut.utils import auxfun_multianimal
 
 from ..helpers import (
     get_config_path,
+    read_config,
+)
+from ..runtime import (
+    resolve_device,
 )
 
-def evaluate_pretrained(user:str, working_dir:str, project_name:str):
+# File (in the evaluation results folder) holding the metrics of all snapshots
+metrics_cache = 'snapshot-metrics.yaml'
+
+# Metric used to pick the best snapshot
+best_metric = 'test rmse'
+
+# Default number of worker processes when evaluating on the CPU
+cpu_workers = 2
+
+
+def _loader(config_path:str, shuffle:int, trainset_index:int):
+    """Get the DLC data loader of a shuffle"""
+    return DLCLoader(config=config_path, shuffle=shuffle,
+                     trainset_index=trainset_index)
+
+def find_snapshots(config_path:str)->list:
+    """List all snapshots of all shuffles in the current iteration.
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+
+    Returns
+    -------
+      snapshots:
+        List of dicts with the `shuffle`, `trainset_index`, `snapshot` (path)
+        and `detector` (path or `None`) of each snapshot.
+    """
+    config = read_config(config_path)
+    fractions = [int(round(100 * f)) for f in config['TrainingFraction']]
+    models_dir = (Path(os.path.dirname(config_path)) / 'dlc-models-pytorch'
+                  / f"iteration-{config['iteration']}")
+    snapshots = []
+    for model_folder in sorted(models_dir.glob('*shuffle*')):
+        match = re.search(r'trainset(\d+)shuffle(\d+)$', model_folder.name)
+        if match is None or int(match.group(1)) not in fractions:
+            continue
+        shuffle = int(match.group(2))
+        trainset_index = fractions.index(int(match.group(1)))
+        loader = _loader(config_path, shuffle, trainset_index)
+        detector = None
+        if loader.pose_task == Task.TOP_DOWN:
+            detectors = get_model_snapshots(-1, loader.model_folder, Task.DETECT)
+            detector = detectors[0].path if detectors else None
+        for snapshot in get_model_snapshots('all', loader.model_folder,
+                                            loader.pose_task):
+            snapshots.append(dict(shuffle=shuffle, trainset_index=trainset_index,
+                                  snapshot=str(snapshot.path),
+                                  detector=detector and str(detector)))
+    return snapshots
+
+def test_set_hash(config_path:str, shuffle:int, trainset_index:int)->str:
+    """Compute a hash of the test images and their labels of a shuffle"""
+    data = _loader(config_path, shuffle, trainset_index).load_data(mode='test')
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+def snapshot_key(snapshot:dict)->str:
+    """Identify a snapshot by its shuffle, name, size and modification time"""
+    parts = []
+    for path in (snapshot['snapshot'], snapshot['detector']):
+        if path is not None:
+            stat = os.stat(path)
+            parts.append(f"{Path(path).name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return (f"shuffle{snapshot['shuffle']}-trainset{snapshot['trainset_index']}/"
+            + "/".join(parts))
+
+def evaluate_snapshot(config_path:str, snapshot:dict,
+                      device:str|None=None, threads:int|None=None)->dict:
+    """Evaluate a single snapshot on the train and test images.
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+    snapshot:
+      Description of the snapshot, see `find_snapshots`.
+    device:
+      Device to run the evaluation on.
+    threads:
+      Optional number of threads torch may use (on the CPU).
+
+    Returns
+    -------
+      metrics:
+        The metrics prefixed with the data split (e.g. `test rmse`).
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    config = read_config(config_path)
+    loader = _loader(config_path, snapshot['shuffle'], snapshot['trainset_index'])
+    individuals, unique_bodyparts, bodyparts = (
+        auxfun_multianimal.extractindividualsandbodyparts(config)
+    )
+    pose_runner, detector_runner = get_inference_runners(
+        model_config=loader.model_cfg,
+        snapshot_path=snapshot['snapshot'],
+        max_individuals=len(individuals),
+        num_bodyparts=len(bodyparts),
+        num_unique_bodyparts=len(unique_bodyparts),
+        device=device,
+        detector_path=snapshot['detector'],
+    )
+    metrics = {}
+    for mode in ('train', 'test'):
+        results, _ = evaluate(pose_runner=pose_runner, loader=loader, mode=mode,
+                              detector_runner=detector_runner,
+                              pcutoff=config.get('pcutoff', 0.6))
+        metrics.update({f"{mode} {k}": float(v) for k, v in results.items()})
+    return metrics
+
+def evaluate_snapshots(config_path:str, workers:int|None=None,
+                       device:str|None=None, plotting:bool=False)->pd.DataFrame:
+    """Evaluate all snapshots that have not been evaluated yet.
+
+    The metrics are cached per snapshot and test set, hence only new
+    snapshots (or snapshots whose test set changed) are evaluated. These are
+    evaluated in parallel worker processes.
+
+    Parameters
+    ----------
+    config_path:
+      Path to the project config file.
+    workers:
+      Number of worker processes. Defaults to one per GPU when running on
+      `'cuda'`, one for a specific GPU (e.g. `'cuda:1'`) and to
+      `cpu_workers` otherwise. On the CPU, the cores are split among the
+      workers.
+    device:
+      Device to run the evaluations on. With `'cuda'` the snapshots are
+      distributed over all GPUs. Defaults to `'cuda'` if available.
+    plotting:
+      Plot the predictions of the best snapshot of each shuffle once all
+      snapshots are evaluated.
+
+    Returns
+    -------
+      metrics:
+        Table with one row per snapshot, sorted by `best_metric`.
+    """
+    config = read_config(config_path)
+    results_dir = (Path(os.path.dirname(config_path)) / 'evaluation-results-pytorch'
+                   / f"iteration-{config['iteration']}")
+    results_dir.mkdir(parents=True, exist_ok=True)
+    cache_path = results_dir / metrics_cache
+    cache = {}
+    if cache_path.exists():
+        with open(cache_path, 'r') as file:
+            cache = yaml.safe_load(file) or {}
+
+    snapshots = find_snapshots(config_path)
+    test_hashes = {
+        split: test_set_hash(config_path, *split)
+        for split in {(s['shuffle'], s['trainset_index']) for s in snapshots}
+    }
+    keys = [snapshot_key(s) for s in snapshots]
+    missing = [
+        (key, s) for key, s in zip(keys, snapshots)
+        if cache.get(key, {}).get('test_hash')
+        != test_hashes[(s['shuffle'], s['trainset_index'])]
+    ]
+
+    # Evaluate the missing snapshots in parallel
+    if missing:
+        # each worker loads its own models, so do not overload the GPUs
+        device = resolve_device(device)
+        devices = [device] * len(missing)
+        threads = None
+        if device == 'cuda':
+            nbr_gpus = max(torch.cuda.device_count(), 1)
+            devices = [f"cuda:{i % nbr_gpus}" for i in range(len(missing))]
+            workers = workers or nbr_gpus
+        elif device.startswith('cuda'):
+            workers = workers or 1
+        else:
+            # avoid oversubscribing the cores with the threads of all workers
+            workers = workers or cpu_workers
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            results = executor.map(evaluate_snapshot,
+                                   [config_path] * len(missing),
+                                   [s for _, s in missing],
+                                   devices,
+                                   [threads] * len(missing))
+            for (key, s), metrics in zip(missing, results):
+                cache[key] = dict(
+                    test_hash=test_hashes[(s['shuffle'], s['trainset_index'])],
+                    metrics=metrics,
+                )
+                # store after each snapshot to keep the results of interrupted runs
+                with open(cache_path, 'w') as file:
+                    yaml.dump(cache, file, default_flow_style=False)
+
+    # Consolidate the metrics of all current snapshots
+    table = pd.DataFrame([
+        dict(shuffle=s['shuffle'], trainset_index=s['trainset_index'],
+             snapshot=Path(s['snapshot']).name, **cache[key]['metrics'])
+        for key, s in zip(keys, snapshots)
+    ])
+    if best_metric in table:
+        table = table.sort_values(best_metric, ignore_index=True)
+    table.to_csv(results_dir / 'snapshot-metrics.csv', index=False)
+
+    # Plot the predictions of the best snapshots (deferred)
+    if plotting and not table.empty:
+        best = table.groupby(['shuffle', 'trainset_index'], sort=False).head(1)
+        for row in best.itertuples():
+            dlc.evaluate_network(config=config_path, Shuffles=[row.shuffle],
+                                 trainingsetindex=row.trainset_index,
+                                 snapshots_to_evaluate=[Path(row.snapshot).stem],
+                                 plotting=True)
+    return table
+
+def evaluate_pretrained(user:str, working_dir:str, project_name:str,
+                        incremental:bool=False, workers:int|None=None,
+                        device:str|None=None, plotting:bool=True):
     """Evaluate a trained DeepLabCut model.
 
     This function performs the following steps:
@@ -21,12 +262,20 @@ def evaluate_pretrained(user:str, working_dir:str, project_name:str):
         user (str): The username of the experimenter for the project.
         working_dir (str): The directory where the project is located.
         project_name (str): The name of the existing project.
-        model (str): The name of the pretrained model to be evaluated.
+        incremental (bool): Evaluate all snapshots of all shuffles that have
+            not been evaluated yet in parallel and report a consolidated metrics
+            table (see `evaluate_snapshots`).
+        workers (int): Number of worker processes used in incremental mode.
+            Defaults to one per GPU, or a few on the CPU (see
+            `evaluate_snapshots`).
+        device (str): Device to run the evaluations on in incremental mode.
+        plotting (bool): Whether to plot the predictions. In incremental mode
+            only the best snapshot of each shuffle is plotted.
 
     Returns:
-        None: This function does not return any value. It performs actions to evaluate
-        the trained model.
-    
+        pd.DataFrame | None: The metrics of all snapshots in incremental mode,
+        otherwise `None`.
+
     Raises:
         Exception: If there is an error during the evaluation of the model.
     """
@@ -34,7 +283,10 @@ def evaluate_pretrained(user:str, working_dir:str, project_name:str):
                                   project_name=project_name,
                                   user=user)
 
-    dlc.evaluate_network(config=config_path, plotting=True)
+    if incremental:
+        return evaluate_snapshots(config_path, workers=workers, device=device,
+                                  plotting=plotting)
+    dlc.evaluate_network(config=config_path, plotting=plotting)
 
 def get_args():
     """Fetch command line arguments
@@ -46,23 +298,34 @@ def get_args():
     parser.add_argument('--user', type=str, default='ml_user', help='Username for the project.')
     parser.add_argument('--working_dir', type=str, default='/home/ml_user', help='Working directory for the project.')
     parser.add_argument('--project_name', type=str, default='PretrainedTracker', help='Name of the existing project.')
+    parser.add_argument('--incremental', action='store_true', help='Evaluate all new snapshots in parallel and report a metrics table.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes used with --incremental (default: one per GPU, 2 on the CPU).')
+    parser.add_argument('--device', type=str, default=None, help="Device used with --incremental, e.g. 'cuda', 'cuda:1' or 'cpu'.")
+    parser.add_argument('--no_plotting', action='store_true', help='Do not plot the predictions.')
 
     # Add example usage to the help message
     parser.epilog = (
         "Example usage:\n"
         "  python your_script.py --user new_user --working_dir /home/new_user --project_name NewTracker --model another_model\n"
+        "  python your_script.py --incremental --workers 4 --no_plotting\n"
         "  python your_script.py  # Use default values for all parameters"
     )
 
     args = parser.parse_args()
-    
+
     return args
 
 def main():
     """Script entrypoint
     """
     args = get_args()
-    evaluate_pretrained(args.user, args.working_dir, args.project_name)
+    table = evaluate_pretrained(args.user, args.working_dir, args.project_name,
+                                incremental=args.incremental,
+                                workers=args.workers,
+                                device=args.device,
+                                plotting=not args.no_plotting)
+    if table is not None:
+        print(table.to_string())
 
 
 if __name__ == "__main__":
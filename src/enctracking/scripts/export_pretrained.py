@@ -0,0 +1,261 @@
+"""Export a fine-tuned model for fast inference on CPU-only machines.
+
+This is an optional step after evaluate_pretrained.py.
+The exported models can be used by tracking_pretrained.py (see its
+`--exported_model` option).
+"""
+
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+import yaml
+from deeplabcut.pose_estimation_pytorch.apis.utils import (
+    get_inference_runners,
+    get_model_snapshots,
+)
+from deeplabcut.pose_estimation_pytorch.data import DLCLoader
+from deeplabcut.pose_estimation_pytorch.task import Task
+from deeplabcut.utils import auxfun_multianimal
+
+from ..helpers import (
+    get_config_path,
+    read_config,
+)
+from ..runtime import (
+    export_metadata,
+    model_inputs,
+    quantize_module,
+    export_module,
+    swap_models,
+    predict,
+    benchmark,
+)
+
+def export_pretrained(user:str, working_dir:str, project_name:str,
+                      export_dir:str|None=None, shuffle:int=1,
+                      trainset_index:int=0, snapshot_index:int=-1,
+                      detector_snapshot_index:int=-1, quantized:bool=False,
+                      max_deviation:float=2.0, max_mismatch:float=0.01,
+                      batch_size:int=1, trace_frames:int=4,
+                      calibration_frames:int=32):
+    """Export the fine-tuned detector and pose model to TorchScript.
+
+    This function performs the following steps:
+    1. Retrieves the configuration path for the specified project.
+    2. Loads the detector and pose model snapshots.
+    3. Optionally quantizes the pose model (static int8, calibrated on the
+       held-out frames) and exports the models to TorchScript, optimized for
+       CPU inference.
+    4. Validates that the exported models predict the same keypoints on the
+       held-out (test) frames.
+    5. Reports the inference speed (frames/s) before and after the export.
+
+    Args:
+        user (str): The username of the experimenter for the project.
+        working_dir (str): The directory where the project is located.
+        project_name (str): The name of the existing project.
+        export_dir (str): Where to write the exported models to. Defaults to
+            the `exported` folder in the model folder of the shuffle.
+        shuffle (int): The shuffle of the model to export.
+        trainset_index (int): The index of the training fraction to use.
+        snapshot_index (int): The index of the pose model snapshot to export.
+        detector_snapshot_index (int): The index of the detector snapshot to
+            export (top-down models only).
+        quantized (bool): Whether to quantize the pose model to int8. Whether
+            the quantized model is accurate enough is decided by the
+            validation (`max_deviation` and `max_mismatch`).
+        max_deviation (float): Tolerated mean keypoint deviation (in pixels).
+        max_mismatch (float): Tolerated fraction of keypoints that are detected
+            (above `pcutoff`) by only one of the two models.
+        batch_size (int): The batch size to use for the validation.
+        trace_frames (int): Number of held-out frames used to trace (and check
+            the trace of) the pose model if it cannot be scripted.
+        calibration_frames (int): Number of held-out frames used to calibrate
+            the quantization.
+
+    Returns:
+        dict: Description of the export, including the keypoint agreement and
+        the benchmark results. It is also written to `export.yaml` in
+        `export_dir`.
+
+    Raises:
+        ValueError: If the exported models do not agree with the original ones.
+            The export is then marked as not validated and cannot be used.
+        Exception: If there is an error while loading or exporting the models.
+    """
+    config_path = get_config_path(working_dir=working_dir,
+                                  project_name=project_name,
+                                  user=user)
+    config = read_config(config_path)
+
+    # Load the fine-tuned models
+    loader = DLCLoader(config=config_path, shuffle=shuffle,
+                       trainset_index=trainset_index)
+    model_folder = Path(loader.model_folder)
+    pose_snapshots = get_model_snapshots('all', model_folder, loader.pose_task)
+    pose_snapshot = pose_snapshots[snapshot_index]
+    detector_snapshots = []
+    detector_snapshot = None
+    if loader.pose_task == Task.TOP_DOWN:
+        detector_snapshots = get_model_snapshots('all', model_folder, Task.DETECT)
+        detector_snapshot = detector_snapshots[detector_snapshot_index]
+    individuals, unique_bodyparts, bodyparts = (
+        auxfun_multianimal.extractindividualsandbodyparts(config)
+    )
+
+    def _get_runners(device):
+        return get_inference_runners(
+            model_config=loader.model_cfg,
+            snapshot_path=pose_snapshot.path,
+            max_individuals=len(individuals),
+            num_bodyparts=len(bodyparts),
+            num_unique_bodyparts=len(unique_bodyparts),
+            batch_size=batch_size,
+            device=device,
+            detector_path=getattr(detector_snapshot, 'path', None),
+        )
+
+    pose_runner, detector_runner = _get_runners('cpu')
+
+    # Export the models
+    export_dir = Path(export_dir or model_folder / 'exported')
+    export_dir.mkdir(parents=True, exist_ok=True)
+    images = [image['file_name']
+              for image in loader.load_data(mode='test')['images']]
+    if not images:
+        raise ValueError("There are no held-out frames to validate against.")
+
+    # Calibrate and trace (if it cannot be scripted) the pose model on real
+    # held-out inputs
+    contexts = (detector_runner.inference(images=images)
+                if detector_runner is not None else [{}] * len(images))
+    pose_inputs = [model_inputs(pose_runner, image, context)
+                   for image, context in zip(images, contexts)]
+    pose_inputs = [inputs for inputs in pose_inputs if len(inputs)]
+    pose_model = pose_runner.model
+    if quantized:
+        pose_model = quantize_module(pose_model, pose_inputs[:calibration_frames])
+    export_module(pose_model, export_dir / 'pose.pt',
+                  example_inputs=pose_inputs[:trace_frames])
+    metadata = dict(
+        pose_model='pose.pt',
+        pose_snapshot=str(pose_snapshot.path),
+        detector_model=None,
+        detector_snapshot=None,
+        quantized=quantized,
+        # where the snapshots are, so the exported models can be matched
+        shuffle=shuffle,
+        trainset_index=trainset_index,
+        snapshot_index=pose_snapshots.index(pose_snapshot),
+        detector_snapshot_index=None,
+        validated=False,
+    )
+    if detector_runner is not None:
+        # tracing would bake in the data-dependent NMS and score filtering
+        try:
+            export_module(detector_runner.model, export_dir / 'detector.pt')
+        except Exception as e:
+            warnings.warn(f"The detector could not be exported:\n{e}\n"
+                          "It will keep running in eager mode.")
+        else:
+            metadata['detector_model'] = 'detector.pt'
+        metadata['detector_snapshot'] = str(detector_snapshot.path)
+        metadata['detector_snapshot_index'] = detector_snapshots.index(detector_snapshot)
+    with open(export_dir / export_metadata, 'w') as file:
+        yaml.dump(metadata, file, default_flow_style=False)
+
+    # Validate the exported models against the original ones
+    exported_pose_runner, exported_detector_runner = swap_models(
+        *_get_runners('cpu'), export_dir=export_dir, require_validated=False
+    )
+    original = predict(pose_runner, detector_runner, images)
+    exported = predict(exported_pose_runner, exported_detector_runner, images)
+    pcutoff = config.get('pcutoff', 0.6)
+    original_detected = original[..., 2] >= pcutoff
+    exported_detected = exported[..., 2] >= pcutoff
+    both = original_detected & exported_detected
+    either = original_detected | exported_detected
+    deviation = np.linalg.norm(original[..., :2] - exported[..., :2], axis=-1)[both]
+    agreement = dict(
+        nbr_frames=len(images),
+        nbr_keypoints=int(either.sum()),
+        nbr_mismatched=int((original_detected ^ exported_detected).sum()),
+        mean_deviation=float(deviation.mean()) if deviation.size else None,
+        max_deviation=float(deviation.max()) if deviation.size else None,
+    )
+    metadata['agreement'] = agreement
+    problems = []
+    if agreement['nbr_mismatched'] > max_mismatch * max(agreement['nbr_keypoints'], 1):
+        problems.append(f"{agreement['nbr_mismatched']} of "
+                        f"{agreement['nbr_keypoints']} keypoints are detected by "
+                        f"only one of the models ({max_mismatch=})")
+    if agreement['mean_deviation'] is not None \
+            and agreement['mean_deviation'] > max_deviation:
+        problems.append(f"the keypoints deviate by "
+                        f"{agreement['mean_deviation']:.2f} pixels on average "
+                        f"({max_deviation=})")
+    if problems:
+        # make sure the failed export is never used
+        metadata['pose_model'] = metadata['detector_model'] = None
+        with open(export_dir / export_metadata, 'w') as file:
+            yaml.dump(metadata, file, default_flow_style=False)
+        raise ValueError("The exported models do not agree with the original "
+                         "ones: " + "; ".join(problems))
+    metadata['validated'] = True
+
+    # Benchmark the inference speed
+    metadata['frames_per_second'] = dict(
+        original=benchmark(pose_runner, detector_runner, images),
+        exported=benchmark(exported_pose_runner, exported_detector_runner, images),
+    )
+    with open(export_dir / export_metadata, 'w') as file:
+        yaml.dump(metadata, file, default_flow_style=False)
+    return metadata
+
+def get_args():
+    """Fetch command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Export a fine-tuned DeepLabCut model for CPU inference.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--user', type=str, default='ml_user', help='Username for the project.')
+    parser.add_argument('--working_dir', type=str, default='/home/ml_user', help='Working directory for the project.')
+    parser.add_argument('--project_name', type=str, default='PretrainedTracker', help='Name of the existing project.')
+    parser.add_argument('--export_dir', type=str, default=None, help='Where to write the exported models to.')
+    parser.add_argument('--shuffle', type=int, default=1, help='The shuffle of the model to export.')
+    parser.add_argument('--snapshot_index', type=int, default=-1, help='The index of the pose model snapshot to export.')
+    parser.add_argument('--detector_snapshot_index', type=int, default=-1, help='The index of the detector snapshot to export.')
+    parser.add_argument('--quantized', action='store_true', help='Quantize the pose model to int8 (calibrated on the held-out frames).')
+    parser.add_argument('--max_deviation', type=float, default=2.0, help='Tolerated mean keypoint deviation in pixels.')
+    parser.add_argument('--max_mismatch', type=float, default=0.01, help='Tolerated fraction of keypoints detected by only one model.')
+
+    # Add example usage to the help message
+    parser.epilog = (
+        "Example usage:\n"
+        "  export_pretrained --user new_user --working_dir /home/new_user --project_name NewTracker --quantized\n"
+        "  export_pretrained  # Use default values for all parameters"
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    """Script entrypoint
+    """
+    args = get_args()
+    metadata = export_pretrained(
+        user=args.user, working_dir=args.working_dir,
+        project_name=args.project_name, export_dir=args.export_dir,
+        shuffle=args.shuffle, snapshot_index=args.snapshot_index,
+        detector_snapshot_index=args.detector_snapshot_index,
+        quantized=args.quantized,
+        max_deviation=args.max_deviation, max_mismatch=args.max_mismatch,
+    )
+    print(yaml.dump(metadata, default_flow_style=False))
+
+if __name__ == "__main__":
+    main()
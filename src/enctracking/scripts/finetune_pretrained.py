@@ -12,9 +12,12 @@ from ..helpers import (
     parts_mapping,
     get_config_path,
 )
+from ..labels import (
+    convert_labeled_data,
+)
 
 def finetune_pretrained(user:str, working_dir:str, project_name:str, model:str,
-                        batch_size:int):
+                        batch_size:int, fast:bool=False, workers:int|None=None):
     """Create a DeepLabCut project, label images, create a training dataset, and train the network.
 
     This function performs the following steps:
@@ -29,12 +32,20 @@ def finetune_pretrained(user:str, working_dir:str, project_name:str, model:str,
         project_name (str): The name of the project to be created.
         model (str): The name of the pretrained model to be used.
         batch_size (int): The batch size to use when fine-tuning.
+        fast (bool): Convert, re-score and validate the labels of all
+            labeled-data folders in parallel instead of running
+            `dlc.convertcsv2h5` and `dlc.check_labels`. Unchanged folders are
+            skipped and only frames that fail the validation are rendered.
+            Frames whose image does not exist are reported and left out.
+        workers (int): Number of worker processes used in fast mode.
 
     Returns:
         None: This function does not return any value. It performs actions to create
         and configure the DeepLabCut project and train the network.
     
     Raises:
+        ValueError: If the labels of a labeled-data folder fail the validation
+            in fast mode. No training dataset is created then.
         Exception: If there is an error during any of the steps in the process.
     """
     config_path = get_config_path(working_dir=working_dir,
@@ -61,10 +72,23 @@ def finetune_pretrained(user:str, working_dir:str, project_name:str, model:str,
     #       - Replace all occurencens of <otheruser> with <user>
     #       - in each of the CollectedData_<user>.csv files
     #       - Finally, run this scipt (or just dlc.convertcsv2h5)
-    dlc.convertcsv2h5(config_path, scorer=user)
-    
-    # Check the labels
-    dlc.check_labels(config_path, visualizeindividuals=True)
+    #       In fast mode all these steps are carried out automatically.
+    if fast:
+        # Convert, re-score and validate the labels in one go
+        failures = convert_labeled_data(config_path, scorer=user, workers=workers)
+        if failures:
+            # these folders were not converted, do not train without them
+            raise ValueError(
+                f"The labels of {len(failures)} labeled-data folders failed the "
+                "validation. Fix the frames shown in "
+                + ", ".join(f"{str(folder)}_labeled" for folder in failures)
+                + " and run this script again."
+            )
+    else:
+        dlc.convertcsv2h5(config_path, scorer=user)
+
+        # Check the labels
+        dlc.check_labels(config_path, visualizeindividuals=True)
 
     # Create the training dataset
     dlc.modelzoo.utils.create_conversion_table(config=config_path,
@@ -94,6 +118,8 @@ def get_args():
     parser.add_argument('--project_name', type=str, default='PretrainedTracker', help='Name of the project.')
     parser.add_argument('--model', type=str, default='superanimal_topviewmouse', help='Pretrained model to use.')
     parser.add_argument('--batch_size', type=int, default=2, help='The batch size to use when fine-tuning.')
+    parser.add_argument('--fast', action='store_true', help='Convert and validate the labels in parallel, skipping unchanged folders.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes used with --fast.')
 
     # Add example usage to the help message
     parser.epilog = (
@@ -113,7 +139,7 @@ def main():
     finetune_pretrained(
         user=args.user, working_dir=args.working_dir,
         project_name=args.project_name, model=args.model,
-        batch_size=args.batch_size
+        batch_size=args.batch_size, fast=args.fast, workers=args.workers
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,435 @@
+"""Select outlier frames from tracked videos for relabeling.
+
+This is an optional step between tracking_pretrained.py and another round of
+finetune_pretrained.py (active learning).
+All frames of all tracked videos are scored together, a diverse set of the
+worst frames is picked and only these frames are extracted into the
+`labeled-data` folder of the project.
+"""
+from typing import Collection
+
+import os
+import argparse
+import warnings
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+import deeplabcut as dlc
+from sklearn.cluster import KMeans
+
+from ..helpers import (
+    skeleton_layout,
+    track_method_suffixes,
+    get_config_path,
+    read_config,
+    find_analysis_file,
+    to_pose_array,
+)
+
+# Default weights of the individual scores (see `score_frames`)
+score_weights = dict(
+    likelihood=1.0,
+    jump=1.0,
+    skeleton=1.0,
+    count=1.0,
+)
+
+
+def load_tracked_poses(videos:Collection, track_method:str|None='ellipse',
+                       destfolder:str|None=None):
+    """Load the analysis results of several videos into a single array.
+
+    Parameters
+    ----------
+    videos:
+      Paths to the tracked videos.
+    track_method:
+      Tracking method used during the analysis.
+    destfolder:
+      Optional folder the analysis results were written to.
+
+    Returns
+    -------
+      poses:
+        Array of shape (frames, individuals, bodyparts, 3) holding x, y and
+        the likelihood of all frames of all videos.
+      video_ids:
+        Index into `videos` for each frame
+      frame_ids:
+        Frame index within its video for each frame
+      bodyparts:
+        The body parts along the 3rd axis of `poses`
+    """
+    dfs = [pd.read_hdf(find_analysis_file(video, track_method=track_method,
+                                          destfolder=destfolder))
+           for video in videos]
+    individuals = list(dict.fromkeys(
+        ind for df in dfs for ind in df.columns.get_level_values('individuals')
+    ))
+    bodyparts = list(dict.fromkeys(
+        bp for df in dfs for bp in df.columns.get_level_values('bodyparts')
+    ))
+    poses = np.concatenate([
+        to_pose_array(df, individuals=individuals, bodyparts=bodyparts)[0]
+        for df in dfs
+    ])
+    video_ids = np.repeat(np.arange(len(dfs)), [len(df) for df in dfs])
+    frame_ids = np.concatenate([np.arange(len(df)) for df in dfs])
+    return poses, video_ids, frame_ids, bodyparts
+
+def score_frames(poses:np.ndarray, video_ids:np.ndarray, bodyparts:list,
+                 pcutoff:float=0.6, nbr_animals:int|None=None,
+                 edge_tolerance:float=2.0, count_window:int=31,
+                 weights:dict|None=None)->pd.DataFrame:
+    """Score all frames by how likely they are to be mislabeled.
+
+    The scores are computed for all frames at once:
+
+    - `likelihood`: One minus the mean likelihood of the detected individuals
+    - `jump`: Largest displacement of a keypoint since the previous frame
+    - `skeleton`: Fraction of the skeleton edges (see `skeleton_layout`) that
+      are more than `edge_tolerance` times longer or shorter than usual
+    - `count`: Deviation of the number of detected individuals from
+      `nbr_animals` (or from the running median if unset)
+
+    Each score is converted into a percentile rank and the weighted sum of the
+    ranks gives the final `score`.
+
+    Parameters
+    ----------
+    poses:
+      Array of shape (frames, individuals, bodyparts, 3), see
+      `load_tracked_poses`.
+    video_ids:
+      Video index of each frame. Jumps are not computed across videos.
+    bodyparts:
+      The body parts along the 3rd axis of `poses`.
+    pcutoff:
+      Likelihood below which a keypoint counts as not detected.
+    nbr_animals:
+      Optional number of individuals expected in each frame.
+    edge_tolerance:
+      Factor by which a skeleton edge may deviate from its median length.
+    count_window:
+      Window size (in frames) of the running median of detected individuals.
+    weights:
+      Optional weights for the scores. Defaults to `score_weights`.
+
+    Returns
+    -------
+      scores:
+        Data frame with one row per frame and a column per score.
+    """
+    weights = {**score_weights, **(weights or {})}
+    xy = poses[..., :2]
+    likelihood = np.nan_to_num(poses[..., 2], nan=0.0)
+    valid = likelihood >= pcutoff
+    detected = valid.any(axis=-1)
+
+    # low likelihood of the detected individuals
+    ind_likelihood = np.where(detected[..., None], likelihood, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean_likelihood = np.nanmean(ind_likelihood, axis=(1, 2))
+    likelihood_score = 1.0 - np.nan_to_num(mean_likelihood, nan=0.0)
+
+    # implausible jumps between consecutive frames of the same video
+    jumps = np.linalg.norm(np.diff(xy, axis=0), axis=-1)
+    jumps[~(valid[1:] & valid[:-1])] = 0.0
+    jumps[video_ids[1:] != video_ids[:-1]] = 0.0
+    jump_score = np.concatenate([[0.0], jumps.max(axis=(1, 2))])
+
+    # skeleton edges that are way too long or too short
+    bp_index = {bp: i for i, bp in enumerate(bodyparts)}
+    edges = np.array(list(dict.fromkeys(
+        tuple(sorted((bp_index[a], bp_index[b])))
+        for a, b in skeleton_layout if a in bp_index and b in bp_index
+    ))).reshape(-1, 2)
+    lengths = np.linalg.norm(xy[:, :, edges[:, 0]] - xy[:, :, edges[:, 1]],
+                             axis=-1)
+    edge_valid = valid[:, :, edges[:, 0]] & valid[:, :, edges[:, 1]]
+    lengths = np.where(edge_valid, lengths, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median_lengths = np.nanmedian(lengths, axis=(0, 1))
+        ratio = lengths / median_lengths
+    violations = (ratio > edge_tolerance) | (ratio < 1 / edge_tolerance)
+    nbr_edges = edge_valid.sum(axis=(1, 2))
+    skeleton_score = np.divide(violations.sum(axis=(1, 2)), nbr_edges,
+                               out=np.zeros(len(poses)), where=nbr_edges > 0)
+
+    # number of individuals that does not match the expectation
+    counts = pd.Series(detected.sum(axis=1))
+    if nbr_animals is None:
+        expected = counts.groupby(video_ids).transform(
+            lambda c: c.rolling(count_window, center=True, min_periods=1).median()
+        )
+    else:
+        expected = nbr_animals
+    count_score = (counts - expected).abs().to_numpy(dtype=float)
+
+    scores = pd.DataFrame(dict(
+        likelihood=likelihood_score,
+        jump=jump_score,
+        skeleton=skeleton_score,
+        count=count_score,
+    ))
+    ranks = scores.rank(pct=True).where(scores > 0, 0.0)
+    scores['score'] = sum(ranks[name] * weight for name, weight in weights.items())
+    return scores
+
+def select_diverse(scores:pd.Series, features:np.ndarray, video_ids:np.ndarray,
+                   nbr_frames:int, frames_per_video:int,
+                   pool_factor:int=5, random_state:int=0)->np.ndarray:
+    """Pick a diverse set of high-scoring frames.
+
+    The candidate pool holds the `pool_factor * frames_per_video` best frames
+    of each video, so a single bad video cannot crowd out the others. The pool
+    is clustered by posture into `nbr_frames` clusters and the best frame of
+    each cluster is selected, without exceeding `frames_per_video` frames from
+    a single video. Remaining slots are filled with the best candidates of the
+    videos whose budget is not yet exhausted.
+
+    Parameters
+    ----------
+    scores:
+      Score of each frame (higher means more likely an outlier).
+    features:
+      Array of shape (frames, n_features) used for the clustering.
+    video_ids:
+      Video index of each frame.
+    nbr_frames:
+      Number of frames to select in total.
+    frames_per_video:
+      Maximal number of frames to select from a single video.
+    pool_factor:
+      Size of the candidate pool of each video relative to `frames_per_video`.
+    random_state:
+      Seed for the clustering.
+
+    Returns
+    -------
+      selected:
+        Positions of the selected frames, best first.
+    """
+    scores = np.asarray(scores)
+    order = np.argsort(-scores, kind='stable')
+    order = order[scores[order] > 0]
+    pool = np.concatenate([np.zeros(0, dtype=int)] + [
+        order[video_ids[order] == video][:pool_factor * frames_per_video]
+        for video in np.unique(video_ids)
+    ])
+    pool = pool[np.argsort(-scores[pool], kind='stable')]
+    selected = []
+    if len(pool):
+        nbr_clusters = min(nbr_frames, len(pool))
+        labels = KMeans(n_clusters=nbr_clusters, n_init='auto',
+                        random_state=random_state).fit_predict(features[pool])
+
+        per_video = {}
+        # go through the candidates from best to worst, one per cluster first,
+        # then fill the remaining slots with the best candidates left
+        taken_clusters = set()
+        for one_per_cluster in (True, False):
+            for position, label in zip(pool, labels):
+                if len(selected) == nbr_frames:
+                    break
+                if position in selected or (one_per_cluster
+                                            and label in taken_clusters):
+                    continue
+                video = video_ids[position]
+                if per_video.get(video, 0) >= frames_per_video:
+                    continue
+                selected.append(position)
+                taken_clusters.add(label)
+                per_video[video] = per_video.get(video, 0) + 1
+        selected.sort(key=lambda position: -scores[position])
+    if len(selected) < nbr_frames:
+        warnings.warn(
+            f"Only {len(selected)} of the requested {nbr_frames} frames were "
+            f"selected (at most {frames_per_video} frames from each of the "
+            f"{len(np.unique(video_ids))} videos, frames with a score of 0 are "
+            "never selected)."
+        )
+    return np.array(selected, dtype=int)
+
+def extract_frames(video:str|Path, frame_ids:Collection[int],
+                   output_dir:str|Path)->list:
+    """Write the requested frames of a video as png images.
+
+    Only the requested frames are decoded: the video is seeked to each
+    frame unless it directly follows the previously read one.
+    The images are named like the ones extracted by DLC (`img<index>.png`).
+
+    Parameters
+    ----------
+    video:
+      Path to the video.
+    frame_ids:
+      Indices of the frames to extract.
+    output_dir:
+      Folder to write the images to.
+
+    Returns
+    -------
+      images:
+        Paths of the written images.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cap = cv2.VideoCapture(str(video))
+    if not cap.isOpened():
+        raise IOError(f"Unable to open {str(video)}")
+    nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    index_length = int(np.ceil(np.log10(max(nframes, 2))))
+    images = []
+    next_frame = 0
+    try:
+        for index in sorted(set(int(i) for i in frame_ids)):
+            image = output_dir / f"img{str(index).zfill(index_length)}.png"
+            if image.exists():
+                continue
+            if index != next_frame:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ok, frame = cap.read()
+            next_frame = index + 1
+            if not ok:
+                warnings.warn(f"Could not read frame {index} of {str(video)}")
+                next_frame = -1
+                continue
+            cv2.imwrite(str(image), frame)
+            images.append(image)
+    finally:
+        cap.release()
+    return images
+
+def select_outliers(user:str, working_dir:str, project_name:str,
+                    videos_to_score:Collection, nbr_frames:int,
+                    frames_per_video:int, track_method:str|None='ellipse',
+                    nbr_animals:int|None=None, destfolder:str|None=None):
+    """Select outlier frames of tracked videos and extract them for labeling.
+
+    This function performs the following steps:
+    1. Retrieves the configuration path for the specified project.
+    2. Loads the tracking results of all videos and scores all frames.
+    3. Selects a diverse set of the highest scoring frames.
+    4. Adds the videos of the selected frames to the project, if needed.
+    5. Extracts the selected frames into the `labeled-data` folder.
+
+    Args:
+        user (str): The username of the experimenter for the project.
+        working_dir (str): The directory where the project is located.
+        project_name (str): The name of the existing project.
+        videos_to_score (list of str): A list of tracked video file paths.
+        nbr_frames (int): The total number of frames to select.
+        frames_per_video (int): The maximal number of frames to select per video.
+        track_method (str): The tracking method used when analyzing the videos
+            (see `track_method_suffixes`), `None` for untracked predictions.
+        nbr_animals (int): Optional number of individuals expected in each frame.
+        destfolder (str): Optional folder the analysis results were written to.
+
+    Returns:
+        pd.DataFrame: The scores of the selected frames along with the video
+        and frame index.
+
+    Raises:
+        FileNotFoundError: If no analysis file is found for one of the videos.
+    """
+    config_path = get_config_path(working_dir=working_dir,
+                                  project_name=project_name,
+                                  user=user)
+    config = read_config(config_path)
+
+    # Score all frames of all videos in one go
+    poses, video_ids, frame_ids, bodyparts = load_tracked_poses(
+        videos_to_score, track_method=track_method, destfolder=destfolder
+    )
+    scores = score_frames(poses, video_ids, bodyparts,
+                          pcutoff=config.get('pcutoff', 0.6),
+                          nbr_animals=nbr_animals)
+
+    # Pick a diverse set of frames based on the posture
+    features = poses[..., :2].reshape(len(poses), -1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        features = np.where(np.isnan(features), np.nanmean(features, axis=0),
+                            features)
+    features = np.nan_to_num(features)
+    selected = select_diverse(scores['score'], features, video_ids,
+                              nbr_frames=nbr_frames,
+                              frames_per_video=frames_per_video)
+
+    # Register new videos, otherwise DLC ignores their labeled frames
+    registered = {Path(video).resolve() for video in config.get('video_sets') or {}}
+    new_videos = list(dict.fromkeys(
+        str(Path(videos_to_score[video_id]).resolve())
+        for video_id in np.unique(video_ids[selected])
+        if Path(videos_to_score[video_id]).resolve() not in registered
+    ))
+    if new_videos:
+        dlc.add_new_videos(config=config_path, videos=new_videos,
+                           copy_videos=False)
+
+    # Extract the frames to the labeled-data folder
+    labeled_data = Path(os.path.dirname(config_path)) / 'labeled-data'
+    for video_id in np.unique(video_ids[selected]):
+        video = Path(videos_to_score[video_id])
+        extract_frames(video, frame_ids[selected][video_ids[selected] == video_id],
+                       output_dir=labeled_data / video.stem)
+
+    result = scores.iloc[selected].copy()
+    result.insert(0, 'frame', frame_ids[selected])
+    result.insert(0, 'video', [str(videos_to_score[i]) for i in video_ids[selected]])
+    return result.reset_index(drop=True)
+
+def get_args():
+    """Fetch command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Select outlier frames from tracked videos and extract them for relabeling.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--user', type=str, default='ml_user', help='Username for the project.')
+    parser.add_argument('--working_dir', type=str, default='/home/ml_user', help='Working directory for the project.')
+    parser.add_argument('--project_name', type=str, default='PretrainedTracker', help='Name of the existing project.')
+    parser.add_argument('--videos_to_score', type=str, nargs='+', required=True, help='List of tracked video files.')
+    parser.add_argument('--nbr_frames', type=int, default=50, help='Total number of frames to select.')
+    parser.add_argument('--frames_per_video', type=int, default=10, help='Maximal number of frames to select per video.')
+    parser.add_argument('--track_method', type=str, default='ellipse',
+                        choices=[str(method).lower() for method in track_method_suffixes],
+                        help='Tracking method used when analyzing the videos ("none" for untracked predictions).')
+    parser.add_argument('--nbr_animals', type=int, default=None, help='Number of individuals expected in each frame.')
+    parser.add_argument('--destfolder', type=str, default=None, help='Folder the analysis results were written to.')
+
+    # Add example usage to the help message
+    parser.epilog = (
+        "Example usage:\n"
+        "  select_outliers --user new_user --working_dir /home/new_user --project_name NewTracker "
+        "--videos_to_score /path/to/video1.mp4 /path/to/video2.mp4 --nbr_frames 40 --frames_per_video 8\n"
+        "  select_outliers --videos_to_score /path/to/video1.mp4  # Use default values for other parameters"
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    """Script entrypoint
+    """
+    args = get_args()
+    selected = select_outliers(
+        user=args.user, working_dir=args.working_dir,
+        project_name=args.project_name,
+        videos_to_score=args.videos_to_score,
+        nbr_frames=args.nbr_frames,
+        frames_per_video=args.frames_per_video,
+        track_method=None if args.track_method == 'none' else args.track_method,
+        nbr_animals=args.nbr_animals,
+        destfolder=args.destfolder,
+    )
+    print(selected.to_string())
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,24 @@ import argparse
 from pathlib import Path
 from deeplabcut.modelzoo.video_inference import video_inference_superanimal
 
-def main(video_path: str,
+from enctracking.multicamera import (
+    superanimal_runners,
+    multi_camera_inference,
+    write_predictions,
+)
+
+# Parameters that only affect the video adaptation
+video_adapt_params = ('video_adapt_batch_size', 'pseudo_threshold',
+                      'detector_epochs', 'pose_epochs')
+
+def main(video_path: str|list,
          dest_folder: str,
          superanimal_name: str,
          model_name: str,
          detector_name: str,
          max_individuals: int,
          device: str,
+         multi_camera: bool = False,
          **kwargs
          ) -> None:
     """Use ModelZoo to detect poses
@@ -17,17 +28,59 @@ def main(video_path: str,
     Parameters
     ----------
     video_path:
-      Path to the video to analyze
+      Path to the video to analyze.
+      With `multi_camera` a list of the synchronized videos of all cameras.
     superanimal_name:
       Identifier of the pretrained model to use
+    multi_camera:
+      Decode the videos of all cameras together and pack their frames into
+      shared batches (`batch_size` per camera). The predictions are written
+      per camera with aligned frame indices. Video adaptation is not
+      available in this mode.
+    **kwargs:
+      Further parameters of `video_inference_superanimal`.
+      With `multi_camera` only `batch_size`, `detector_batch_size` and
+      `bbox_threshold` are supported (besides `video_adapt=False`).
     """
     out_dir = Path(dest_folder)
     if not out_dir.exists():
         warnings.warn(f"Creating new directory {str(out_dir)}")
         out_dir.mkdir(parents=True)
 
+    videos = [video_path] if isinstance(video_path, str) else list(video_path)
+    if multi_camera:
+        params = dict(kwargs)
+        if params.pop('video_adapt', False):
+            raise ValueError("Video adaptation is not available with "
+                             "multi_camera, use video_adapt=False.")
+        for name in video_adapt_params:
+            params.pop(name, None)
+        batch_size = params.pop('batch_size', 1)
+        detector_batch_size = params.pop('detector_batch_size', batch_size)
+        bbox_threshold = params.pop('bbox_threshold', None)
+        if params:
+            raise TypeError(f"Unsupported parameters with multi_camera: {list(params)}")
+        pose_runner, detector_runner, scorer, bodyparts = superanimal_runners(
+            superanimal_name=superanimal_name,
+            model_name=model_name,
+            detector_name=detector_name,
+            max_individuals=max_individuals,
+            batch_size=batch_size * len(videos),
+            detector_batch_size=detector_batch_size * len(videos),
+            bbox_threshold=bbox_threshold,
+            device=device,
+        )
+        predictions = multi_camera_inference(videos, pose_runner,
+                                             detector_runner,
+                                             batch_size=batch_size)
+        for video, camera_predictions in zip(videos, predictions):
+            write_predictions(camera_predictions, video, scorer,
+                              individuals=[], bodyparts=bodyparts,
+                              destfolder=out_dir)
+        return None
+
     video_inference_superanimal(
-        videos=[video_path],
+        videos=videos,
         superanimal_name=superanimal_name,
         model_name=model_name,
         detector_name=detector_name,
@@ -41,7 +94,8 @@ def main(video_path: str,
 if __name__ == '__main__':
     # Set up argument parsing
     parser = argparse.ArgumentParser(description='Analyze video using DeepLabCut ModelZoo.')
-    parser.add_argument('video_path', type=str, help='Path to the video to analyze')
+    parser.add_argument('video_path', type=str, nargs='+',
+                        help='Path to the video to analyze (one per camera with --multi_camera)')
     parser.add_argument('--dest_folder', type=str,
                         help='Where to store the results')
     parser.add_argument('--superanimal_name', type=str,
@@ -59,13 +113,24 @@ if __name__ == '__main__':
     parser.add_argument('--device', type=str,
                         default='auto',
                         help='What device to use')
+    parser.add_argument('--multi_camera', action='store_true',
+                        help='The videos are synchronized recordings of several cameras')
+    parser.add_argument('--no_video_adapt', action='store_true',
+                        help='Do not adapt the model to the video (implied by --multi_camera)')
     # Parse the arguments
     args = parser.parse_args()
 
+    # video adaptation is not supported with several cameras
+    video_adapt = not args.no_video_adapt
+    if args.multi_camera and video_adapt:
+        warnings.warn("Video adaptation is not supported with --multi_camera, "
+                      "the pretrained model is used as is.")
+        video_adapt = False
+
     # setting all parameters
     params = dict(
         detector_batch_size=4,
-        video_adapt=True,
+        video_adapt=video_adapt,
         batch_size=4,
         video_adapt_batch_size=4,
         pseudo_threshold=0.05,
@@ -88,5 +153,6 @@ if __name__ == '__main__':
          model_name=args.model_name,
          detector_name=args.detector_name,
          max_individuals=args.max_individuals,
+         multi_camera=args.multi_camera,
          **params
          )
@@ -13,9 +13,23 @@ import deeplabcut as dlc
 
 from ..helpers import (
     get_config_path,
+    read_config,
+)
+from ..runtime import (
+    read_export,
+    use_exported_models,
+)
+from ..multicamera import (
+    project_runners,
+    multi_camera_inference,
+    precomputed_predictions,
 )
 
-def tracking_pretrained(user:str, working_dir:str, project_name:str, videos_to_analyze:Collection, batch_size:int):
+def tracking_pretrained(user:str, working_dir:str, project_name:str, videos_to_analyze:Collection, batch_size:int,
+                        exported_model:str|None=None, multi_camera:bool=False,
+                        shuffle:int|None=None, trainingsetindex:int|None=None,
+                        snapshot_index:int|None=None,
+                        detector_snapshot_index:int|None=None):
     """Analyze videos to track individuals using a trained DeepLabCut model.
 
     This function performs the following steps:
@@ -29,26 +43,92 @@ def tracking_pretrained(user:str, working_dir:str, project_name:str, videos_to_a
         project_name (str): The name of the existing project.
         videos_to_analyze (list of str): A list of video file paths to be analyzed.
         batch_size (int): The batch size to use when fine-tuning.
+        exported_model (str): Optional folder with models exported by
+            export_pretrained.py. If set, the inference runs on the CPU through
+            the exported models, using the shuffle and snapshots they were
+            exported from (unless set explicitly).
+        multi_camera (bool): Treat the videos as synchronized recordings of
+            several cameras of the same enclosure. Their frames are decoded
+            together and packed into shared batches (`batch_size` per camera).
+            The predictions of each camera are then written, assembled and
+            tracked by DLC as in the single-camera case, with aligned frame
+            indices. The models are loaded only once.
+        shuffle (int): The shuffle of the model to use. Defaults to 1.
+        trainingsetindex (int): The index of the training fraction to use.
+            Defaults to 0.
+        snapshot_index (int): The index of the pose model snapshot to use.
+            Defaults to `snapshotindex` in the config file.
+        detector_snapshot_index (int): The index of the detector snapshot to
+            use. Defaults to `detector_snapshotindex` in the config file.
 
     Returns:
         None: This function does not return any value. It performs actions to analyze
         the videos and create annotated outputs.
     
     Raises:
+        ValueError: If the exported models were not exported from the selected
+            snapshots.
         Exception: If there is an error during the analysis of the videos.
     """
     config_path = get_config_path(working_dir=working_dir,
                                   project_name=project_name,
                                   user=user)
+    config = read_config(config_path)
+
+    # Select the model, by default like DLC does
+    model_params = dict(shuffle=shuffle, trainingsetindex=trainingsetindex,
+                        snapshot_index=snapshot_index,
+                        detector_snapshot_index=detector_snapshot_index)
+    defaults = dict(shuffle=1, trainingsetindex=0,
+                    snapshot_index=config.get('snapshotindex', -1),
+                    detector_snapshot_index=config.get('detector_snapshotindex', -1))
+    analyze_params = dict()
+    if exported_model:
+        # analyze with the exported snapshots, not the ones set in config.yaml
+        metadata = read_export(exported_model)
+        defaults.update(shuffle=metadata['shuffle'],
+                        trainingsetindex=metadata['trainset_index'],
+                        snapshot_index=metadata['snapshot_index'])
+        if metadata.get('detector_snapshot_index') is not None:
+            defaults['detector_snapshot_index'] = metadata['detector_snapshot_index']
+        analyze_params['device'] = 'cpu'
+    for key, value in model_params.items():
+        analyze_params[key] = defaults[key] if value is None else value
 
     # Run the analysis of the videos
-    scorername = dlc.analyze_videos(config=config_path,
-                                     videos=videos_to_analyze,
-                                     batch_size=batch_size)
+    if multi_camera:
+        # Load the models once and run the inference of all cameras in
+        # shared batches
+        pose_runner, detector_runner = project_runners(
+            config_path, batch_size=batch_size * len(videos_to_analyze),
+            device=analyze_params.get('device'),
+            shuffle=analyze_params['shuffle'],
+            trainset_index=analyze_params['trainingsetindex'],
+            snapshot_index=analyze_params['snapshot_index'],
+            detector_snapshot_index=analyze_params['detector_snapshot_index'],
+            export_dir=exported_model,
+        )
+        predictions = multi_camera_inference(videos_to_analyze, pose_runner,
+                                             detector_runner,
+                                             batch_size=batch_size)
+        # Let DLC write, assemble, track and stitch the results of each camera
+        for video, camera_predictions in zip(videos_to_analyze, predictions):
+            with precomputed_predictions(camera_predictions, pose_runner,
+                                         detector_runner):
+                dlc.analyze_videos(config=config_path, videos=[video],
+                                   batch_size=batch_size, **analyze_params)
+    else:
+        with use_exported_models(exported_model):
+            scorername = dlc.analyze_videos(config=config_path,
+                                             videos=videos_to_analyze,
+                                             batch_size=batch_size,
+                                             **analyze_params)
 
     # Create some annotated videos to check the performance
     dlc.create_video_with_all_detections(config=config_path,
-                                          videos=videos_to_analyze)
+                                          videos=videos_to_analyze,
+                                          shuffle=analyze_params['shuffle'],
+                                          trainingsetindex=analyze_params['trainingsetindex'])
 
 def get_args():
     """Fetch command line arguments
@@ -62,6 +142,12 @@ def get_args():
     parser.add_argument('--project_name', type=str, default='PretrainedTracker', help='Name of the existing project.')
     parser.add_argument('--videos_to_analyze', type=str, nargs='+', required=True, help='List of video files to analyze.')
     parser.add_argument('--batch_size', type=int, default=2, help='The batch size to use when fine-tuning.')
+    parser.add_argument('--exported_model', type=str, default=None, help='Folder with models exported by export_pretrained.')
+    parser.add_argument('--multi_camera', action='store_true', help='The videos are synchronized recordings of several cameras.')
+    parser.add_argument('--shuffle', type=int, default=None, help='The shuffle of the model to use (default: 1).')
+    parser.add_argument('--trainingsetindex', type=int, default=None, help='The index of the training fraction to use (default: 0).')
+    parser.add_argument('--snapshot_index', type=int, default=None, help='The index of the pose model snapshot (default: snapshotindex in config.yaml).')
+    parser.add_argument('--detector_snapshot_index', type=int, default=None, help='The index of the detector snapshot (default: detector_snapshotindex in config.yaml).')
 
     # Add example usage to the help message
     parser.epilog = (
@@ -83,7 +169,13 @@ def main():
     tracking_pretrained(user=args.user, working_dir=args.working_dir,
                         project_name=args.project_name,
                         videos_to_analyze=args.videos_to_analyze,
-                        batch_size=args.batch_size)
+                        batch_size=args.batch_size,
+                        exported_model=args.exported_model,
+                        multi_camera=args.multi_camera,
+                        shuffle=args.shuffle,
+                        trainingsetindex=args.trainingsetindex,
+                        snapshot_index=args.snapshot_index,
+                        detector_snapshot_index=args.detector_snapshot_index)
 
 if __name__ == "__main__":
     main()